@@ -1,33 +1,48 @@
+import io
 import os
 import re
 import asyncio
 import logging
-import requests
+import time
+import secrets
+from collections import OrderedDict
+import aiohttp
+import asyncpg
 
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.constants import ParseMode
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
+from telegram.ext import AIORateLimiter, ApplicationBuilder, CommandHandler, ContextTypes
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 import uvicorn
 
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy import Column, Integer, String, BigInteger, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import NullPool
+from sqlalchemy import Column, Integer, String, BigInteger
 
 # ─── Load config ─────────────────────────────────────────────────────────────
 load_dotenv()
 TOKEN        = os.getenv("TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
-ADMIN_IDS    = set(map(int, os.getenv("ADMIN_ID", "").split(",")))
+ADMIN_IDS    = frozenset(int(x) for x in os.getenv("ADMIN_ID", "").split(",") if x.strip())
 PORT         = int(os.getenv("PORT", 8000))
 LOG_GROUP_ID = int(os.getenv("LOG_GROUP_ID", 0))
 ENSEMBLE_TOKEN = os.getenv("ENSEMBLE_TOKEN")
+WORKER_LANES = int(os.getenv("WORKER_LANES", 32))
+DB_POOL_MIN  = int(os.getenv("DB_POOL_MIN", 5))
+DB_POOL_MAX  = int(os.getenv("DB_POOL_MAX", 20))
+PG_DSN       = (DATABASE_URL or "").replace("+asyncpg", "", 1)
+WEBHOOK_URL  = os.getenv("WEBHOOK_URL", "").rstrip("/")  # public base URL; unset = long polling
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
 
 if not all([TOKEN, DATABASE_URL, ENSEMBLE_TOKEN]):
     print("❌ TOKEN, DATABASE_URL, and ENSEMBLE_TOKEN must be set in .env")
     exit(1)
+if WORKER_LANES <= 0:
+    print("❌ WORKER_LANES must be a positive integer")
+    exit(1)
 
 # ─── Logging ───────────────────────────────────────────────────────────────────
 logging.basicConfig(
@@ -39,33 +54,93 @@ logger = logging.getLogger(__name__)
 # ─── FastAPI health check ──────────────────────────────────────────────────────
 app_fastapi = FastAPI()
 
+tg_app = None  # telegram Application, set in run_bot()
+
 @app_fastapi.get("/")
 async def root():
     return {"message": "Bot is running 🚀"}
 
+@app_fastapi.post("/webhook")
+async def telegram_webhook(request: Request):
+    if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return Response(status_code=403)
+    if tg_app is None:
+        return Response(status_code=503)
+    try:
+        update = Update.de_json(await request.json(), tg_app.bot)
+    except Exception:
+        logger.warning("Rejected malformed webhook payload")
+        return Response(status_code=400)
+    await tg_app.update_queue.put(update)
+    return Response(status_code=200)
+
 async def start_health_check_server():
     config = uvicorn.Config(app_fastapi, host="0.0.0.0", port=PORT, log_level="info")
     server = uvicorn.Server(config)
     await server.serve()
 
 # ─── Database setup ───────────────────────────────────────────────────────────
+# SQLAlchemy is only used for schema setup in init_db; handlers talk to the
+# asyncpg pool directly, so the engine doesn't keep its own pool around.
 Base = declarative_base()
-engine = create_async_engine(DATABASE_URL, echo=False)
-AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+engine = create_async_engine(DATABASE_URL, echo=False, poolclass=NullPool)
+db_pool: asyncpg.Pool = None  # created in run_bot()
+
+# Idempotent migrations, sent as one batch (no bind params → simple query protocol).
+INIT_DDL = """
+    ALTER TABLE users ADD COLUMN IF NOT EXISTS total_views BIGINT DEFAULT 0;
+    CREATE TABLE IF NOT EXISTS allowed_accounts (
+        id SERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        insta_handle VARCHAR NOT NULL
+    );
+    -- covering indexes: per-user reel lists and handle lookups become index-only scans
+    CREATE INDEX IF NOT EXISTS idx_reels_user_id ON reels(user_id, id) INCLUDE (shortcode);
+    CREATE INDEX IF NOT EXISTS idx_allowed_accounts_user_handle ON allowed_accounts(user_id) INCLUDE (insta_handle);
+"""
+
+async def migrate_unique_shortcodes(con):
+    """One-off: dedupe reels and add uq_reels_shortcode, only if it's missing."""
+    if await con.fetchval("SELECT to_regclass('uq_reels_shortcode')"):
+        return
+    async with con.transaction():
+        # a shortcode can only be tracked once; keep the oldest row of any duplicates
+        status = await con.execute(
+            "DELETE FROM reels a USING reels b WHERE a.shortcode = b.shortcode AND a.id > b.id"
+        )
+        removed = int(status.split()[-1])
+        if removed:
+            logger.warning(f"Removed {removed} duplicate reel rows before adding uq_reels_shortcode")
+        await con.execute("""
+            DROP INDEX IF EXISTS idx_reels_user, idx_reels_shortcode, idx_allowed_accounts_user;
+            CREATE UNIQUE INDEX uq_reels_shortcode ON reels(shortcode);
+        """)
 
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
-        await conn.execute(text(
-            "ALTER TABLE users ADD COLUMN IF NOT EXISTS total_views BIGINT DEFAULT 0"
-        ))
-        await conn.execute(text("""
-            CREATE TABLE IF NOT EXISTS allowed_accounts (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                insta_handle VARCHAR NOT NULL
-            )
-        """))
+    async with db_pool.acquire() as con:
+        await migrate_unique_shortcodes(con)
+        await con.execute(INIT_DDL)
+
+# ─── Hot SQL ──────────────────────────────────────────────────────────────────
+# asyncpg prepares each statement once per pool connection and reuses it from
+# the statement cache (keyed by query text), so these stay fixed strings.
+SQL_REEL_PRECHECK = (
+    "SELECT (SELECT insta_handle FROM allowed_accounts WHERE user_id=$1 LIMIT 1), "
+    "EXISTS(SELECT 1 FROM reels WHERE shortcode=$2)"
+)
+# No row back means someone else added the shortcode meanwhile (uq_reels_shortcode).
+SQL_REEL_INSERT = (
+    "INSERT INTO reels(user_id,shortcode) VALUES($1,$2) "
+    "ON CONFLICT (shortcode) DO NOTHING RETURNING id"
+)
+SQL_REEL_DELETE = "DELETE FROM reels WHERE shortcode=$1 AND user_id=$2"
+SQL_USER_STATS = (
+    "SELECT COALESCE((SELECT total_views FROM users WHERE user_id=$1), 0), "
+    "ARRAY(SELECT shortcode FROM reels WHERE user_id=$1 ORDER BY id), "
+    "ARRAY(SELECT insta_handle FROM allowed_accounts WHERE user_id=$1)"
+)
 
 # ─── ORM models ───────────────────────────────────────────────────────────────
 class Reel(Base):
@@ -82,56 +157,179 @@ class User(Base):
     total_views = Column(BigInteger, default=0)
 
 # ─── Utilities ─────────────────────────────────────────────────────────────────
+REEL_URL_RE = re.compile(r"(?:https?://)?(?:www\.|m\.)?instagram\.com/(?:(?P<sup>[^/]+)/)?reels?/(?P<code>[^/?#&]+)")
+
+# user_id -> (expires_at, rendered /stats reply). Every handler that writes a
+# user's reels, handles or views calls invalidate_stats(); the TTL only covers
+# writes made outside the bot.
+STATS_CACHE_TTL = 60
+_stats_cache: dict = {}
+# Bumped on every invalidation so a /stats render that raced a write isn't cached.
+_stats_gen: dict = {}
+_stats_epoch = 0
+
+def invalidate_stats(user_id: int = None):
+    global _stats_epoch
+    if user_id is None:
+        _stats_epoch += 1
+        _stats_cache.clear()
+    else:
+        _stats_gen[user_id] = _stats_gen.get(user_id, 0) + 1
+        _stats_cache.pop(user_id, None)
+
+def _stats_version(user_id: int):
+    return _stats_epoch, _stats_gen.get(user_id, 0)
+
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
+# Updates are processed concurrently; each user is pinned to one lane so their
+# own commands still run in order while other users aren't held up behind them.
+_lanes: list = []  # WORKER_LANES locks, created in run_bot() inside the running loop
+
+# Command log lines for LOG_GROUP_ID are queued and sent in batches by
+# flush_logs(), instead of one extra Telegram message per command.
+_log_q: asyncio.Queue = None  # created in run_bot(), inside the running loop
+LOG_FLUSH_SECS = 2
+TG_MAX_LEN = 4096
+
+async def flush_logs(bot):
+    while True:
+        batch = [await _log_q.get()]
+        await asyncio.sleep(LOG_FLUSH_SECS)
+        while not _log_q.empty():
+            batch.append(_log_q.get_nowait())
+        chunk = ""
+        for line in batch:
+            if chunk and len(chunk) + len(line) + 1 > TG_MAX_LEN:
+                await _send_log(bot, chunk)
+                chunk = ""
+            chunk = f"{chunk}\n{line}" if chunk else line[:TG_MAX_LEN]
+        await _send_log(bot, chunk)
+
+async def _send_log(bot, msg: str):
+    try:
+        await bot.send_message(LOG_GROUP_ID, msg)
+    except Exception:
+        logger.warning("Failed to send log message")
+
 def debug_handler(fn):
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        if LOG_GROUP_ID and update.message:
-            user = update.effective_user
-            name = user.full_name
-            handle = f"@{user.username}" if user.username else ""
-            text = update.message.text or ""
+        uid = update.effective_user.id if update.effective_user else 0
+        async with _lanes[uid % WORKER_LANES]:
+            if LOG_GROUP_ID and update.message:
+                user = update.effective_user
+                name = user.full_name
+                handle = f"@{user.username}" if user.username else ""
+                text = update.message.text or ""
+                _log_q.put_nowait(f"{name} {handle}: {text}")
             try:
-                await context.bot.send_message(LOG_GROUP_ID, f"{name} {handle}: {text}")
-            except Exception:
-                logger.warning("Failed to send log message")
-        try:
-            return await fn(update, context)
-        except Exception as e:
-            logger.exception("Handler error")
-            if update.message:
-                await update.message.reply_text(f"⚠️ Error: {e}")
-            raise
+                return await fn(update, context)
+            except Exception as e:
+                logger.exception("Handler error")
+                if update.message:
+                    await update.message.reply_text(f"⚠️ Error: {e}")
+                raise
     return wrapper
 
+# The loop only holds weak references to tasks; keep long-running ones alive here.
+_background_tasks: set = set()
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# Max Telegram API calls a single handler keeps in flight at once.
+TG_CONCURRENCY = 8
+# Broadcasts fan out wider; the application's AIORateLimiter keeps the actual
+# send rate within Telegram's flood limits.
+BROADCAST_CONCURRENCY = 25
+
+async def chat_full_name(bot, uid: int) -> str:
+    try:
+        chat = await bot.get_chat(uid)
+        return " ".join(filter(None, [chat.first_name, chat.last_name]))
+    except Exception:
+        return str(uid)
+
+# One keep-alive session for all outbound HTTP, created in run_bot().
+http_session: aiohttp.ClientSession = None
+
+# shortcode -> (expires_at, reel data). Every reel in an API response is cached,
+# not just the one asked for, since the endpoint returns the whole batch anyway.
+REEL_CACHE_TTL = 300
+REEL_CACHE_MAX = 4096
+_reel_cache: OrderedDict = OrderedDict()
+
+def _cached_reel(shortcode: str):
+    hit = _reel_cache.get(shortcode)
+    if not hit:
+        return None
+    if hit[0] < time.monotonic():
+        del _reel_cache[shortcode]
+        return None
+    _reel_cache.move_to_end(shortcode)
+    return hit[1]
+
+def _cache_reel(shortcode: str, data: dict):
+    _reel_cache[shortcode] = (time.monotonic() + REEL_CACHE_TTL, data)
+    _reel_cache.move_to_end(shortcode)
+    while len(_reel_cache) > REEL_CACHE_MAX:
+        _reel_cache.popitem(last=False)
+
+# shortcode -> in-flight fetch, so concurrent lookups of one reel share a request.
+_inflight: dict = {}
+
 async def get_reel_data(shortcode: str) -> dict:
     """Get reel data from EnsembleData API"""
+    cached = _cached_reel(shortcode)
+    if cached:
+        return cached
+    task = _inflight.get(shortcode)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_reel_data(shortcode))
+        _inflight[shortcode] = task
+        task.add_done_callback(lambda _: _inflight.pop(shortcode, None))
+    # shield: one caller being cancelled mustn't cancel the fetch for the others
+    return await asyncio.shield(task)
+
+async def _fetch_reel_data(shortcode: str) -> dict:
     try:
         api_url = 'https://ensembledata.com/apis/instagram/user/reels'
         params = {
             'depth': 1,
-            'include_feed_video': True,
+            'include_feed_video': 'True',  # aiohttp only takes str/int query values
             'token': ENSEMBLE_TOKEN
         }
-        
-        response = requests.get(api_url, params=params)
-        response.raise_for_status()
-        
-        data = response.json()
+
+        async with http_session.get(api_url, params=params) as response:
+            response.raise_for_status()
+            data = await response.json()
+
         if not data.get('data', {}).get('reels'):
             raise Exception("No reels found")
             
-        # Find the specific reel by shortcode
         reels = data['data']['reels']
+        found = None
         for reel in reels:
-            if reel['media']['code'] == shortcode:
-                return {
-                    'owner_username': reel['media']['user']['username'],
-                    'view_count': reel['media'].get('view_count', 0),
-                    'play_count': reel['media'].get('play_count', 0)
-                }
-                
+            media = reel.get('media') or {}
+            code = media.get('code')
+            owner = (media.get('user') or {}).get('username')
+            if not code or not owner:
+                continue  # skip incomplete entries rather than failing the whole batch
+            info = {
+                'owner_username': owner,
+                'view_count': media.get('view_count', 0),
+                'play_count': media.get('play_count', 0)
+            }
+            _cache_reel(code, info)
+            if code == shortcode:
+                found = info
+
+        if found:
+            return found
         raise Exception("Reel not found")
     except Exception as e:
         raise Exception(f"Error fetching reel data: {str(e)}")
@@ -169,9 +367,8 @@ async def addaccount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) != 2:
         return await update.message.reply_text("Usage: /addaccount <user_id> <@handle>")
     uid = int(context.args[0]); handle = context.args[1].lstrip("@")
-    async with AsyncSessionLocal() as s:
-        await s.execute(text("INSERT INTO allowed_accounts(user_id, insta_handle) VALUES(:u,:h)"), {"u": uid, "h": handle})
-        await s.commit()
+    await db_pool.execute("INSERT INTO allowed_accounts(user_id, insta_handle) VALUES($1,$2)", uid, handle)
+    invalidate_stats(uid)
     await update.message.reply_text(f"✅ Linked @{handle} to {uid}")
 
 @debug_handler
@@ -181,9 +378,8 @@ async def removeaccount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) != 1:
         return await update.message.reply_text("Usage: /removeaccount <user_id>")
     uid = int(context.args[0])
-    async with AsyncSessionLocal() as s:
-        await s.execute(text("DELETE FROM allowed_accounts WHERE user_id=:u"), {"u": uid})
-        await s.commit()
+    await db_pool.execute("DELETE FROM allowed_accounts WHERE user_id=$1", uid)
+    invalidate_stats(uid)
     await update.message.reply_text(f"🗑️ Unlinked {uid}")
 
 @debug_handler
@@ -191,32 +387,31 @@ async def addreel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         return await update.message.reply_text("❗ Provide a reel link.")
     raw = context.args[0]
-    m = re.search(r"^(?:https?://)?(?:www\.|m\.)?instagram\.com/(?:(?P<sup>[^/]+)/)?reel/(?P<code>[^/?#&]+)", raw)
+    m = REEL_URL_RE.match(raw)
     if not m:
         return await update.message.reply_text("❌ Invalid reel URL.")
     sup, code = m.group("sup"), m.group("code")
     uid = update.effective_user.id
     
-    async with AsyncSessionLocal() as s:
-        acc = (await s.execute(text("SELECT insta_handle FROM allowed_accounts WHERE user_id=:u"), {"u": uid})).fetchone()
-        if not acc:
-            return await update.message.reply_text("🚫 No IG linked—ask admin to /addaccount.")
-        expected = acc[0]
-        
-        try:
-            reel_data = await get_reel_data(code)
-            if reel_data['owner_username'].lower() != expected.lower():
-                return await update.message.reply_text(f"🚫 That reel belongs to @{reel_data['owner_username']}.")
-        except Exception as e:
-            return await update.message.reply_text(f"❌ {str(e)}")
-            
-        dup = (await s.execute(text("SELECT 1 FROM reels WHERE shortcode=:c"), {"c": code})).scalar()
-        if dup:
-            return await update.message.reply_text("⚠️ Already added.")
-            
-        await s.execute(text("INSERT INTO reels(user_id,shortcode) VALUES(:u,:c)"), {"u": uid, "c": code})
-        await s.commit()
-        
+    # Linked handle + duplicate check in one round-trip, before the API call.
+    expected, dup = await db_pool.fetchrow(SQL_REEL_PRECHECK, uid, code)
+    if not expected:
+        return await update.message.reply_text("🚫 No IG linked—ask admin to /addaccount.")
+    if dup:
+        return await update.message.reply_text("⚠️ Already added.")
+
+    try:
+        reel_data = await get_reel_data(code)
+        if reel_data['owner_username'].lower() != expected.lower():
+            return await update.message.reply_text(f"🚫 That reel belongs to @{reel_data['owner_username']}.")
+    except Exception as e:
+        return await update.message.reply_text(f"❌ {str(e)}")
+
+    added = await db_pool.fetchval(SQL_REEL_INSERT, uid, code)
+    if not added:
+        return await update.message.reply_text("⚠️ Already added.")
+    invalidate_stats(uid)
+
     await update.message.reply_text("✅ Reel added!")
 
 @debug_handler
@@ -224,21 +419,20 @@ async def removereel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     raw = context.args[0] if context.args else None
     if not raw:
         return await update.message.reply_text("❗ Provide shortcode or URL.")
-    m = re.search(r"instagram\.com/reel/(?P<code>[^/?#&]+)", raw)
+    # Bare shortcodes are the common case here; skip the regex when it can't match.
+    m = REEL_URL_RE.search(raw) if "instagram.com" in raw else None
     code = m.group("code") if m else raw
     uid = update.effective_user.id
-    async with AsyncSessionLocal() as s:
-        await s.execute(text("DELETE FROM reels WHERE shortcode=:c AND user_id=:u"), {"c": code, "u": uid})
-        await s.commit()
+    await db_pool.execute(SQL_REEL_DELETE, code, uid)
+    invalidate_stats(uid)
     await update.message.reply_text("🗑️ Reel removed.")
 
 @debug_handler
 async def clearreels(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return await update.message.reply_text("🚫 Unauthorized")
-    async with AsyncSessionLocal() as s:
-        await s.execute(text("DELETE FROM reels"))
-        await s.commit()
+    await db_pool.execute("DELETE FROM reels")
+    invalidate_stats()
     await update.message.reply_text("✅ All reels cleared.")
 
 @debug_handler
@@ -248,13 +442,11 @@ async def addviews(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) != 2:
         return await update.message.reply_text("Usage: /addviews <user_id> <views>")
     tid, v = map(int, context.args)
-    async with AsyncSessionLocal() as s:
-        exists = (await s.execute(text("SELECT 1 FROM users WHERE user_id=:u"), {"u": tid})).scalar()
-        if exists:
-            await s.execute(text("UPDATE users SET total_views=total_views+:v WHERE user_id=:u"), {"v": v, "u": tid})
-        else:
-            await s.execute(text("INSERT INTO users(user_id,username,total_views) VALUES(:u,NULL,:v)"), {"u": tid, "v": v})
-        await s.commit()
+    await db_pool.execute(
+        "INSERT INTO users(user_id,username,total_views) VALUES($1,NULL,$2) "
+        "ON CONFLICT (user_id) DO UPDATE SET total_views=users.total_views+EXCLUDED.total_views", tid, v
+    )
+    invalidate_stats(tid)
     await update.message.reply_text(f"✅ Added {v} views to {tid}")
 
 @debug_handler
@@ -264,20 +456,21 @@ async def removeviews(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) != 2:
         return await update.message.reply_text("Usage: /removeviews <user_id> <views>")
     tid, v = map(int, context.args)
-    async with AsyncSessionLocal() as s:
-        await s.execute(text("UPDATE users SET total_views=GREATEST(total_views-:v,0) WHERE user_id=:u"), {"v": v, "u": tid})
-        await s.commit()
+    await db_pool.execute("UPDATE users SET total_views=GREATEST(total_views-$1,0) WHERE user_id=$2", v, tid)
+    invalidate_stats(tid)
     await update.message.reply_text(f"✅ Removed {v} views from {tid}")
 
 @debug_handler
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    async with AsyncSessionLocal() as s:
-        total_videos = (await s.execute(text("SELECT COUNT(*) FROM reels WHERE user_id=:u"), {"u": uid})).scalar() or 0
-        row = (await s.execute(text("SELECT total_views FROM users WHERE user_id=:u"), {"u": uid})).fetchone()
-        total_views = row[0] if row else 0
-        reels = [r[0] for r in (await s.execute(text("SELECT shortcode FROM reels WHERE user_id=:u"), {"u": uid})).fetchall()]
-        handles = [r[0] for r in (await s.execute(text("SELECT insta_handle FROM allowed_accounts WHERE user_id=:u"), {"u": uid})).fetchall()]
+    cached = _stats_cache.get(uid)
+    if cached:
+        if cached[0] > time.monotonic():
+            return await update.message.reply_text(cached[1], parse_mode=ParseMode.HTML)
+        del _stats_cache[uid]
+    version = _stats_version(uid)
+    total_views, reels, handles = await db_pool.fetchrow(SQL_USER_STATS, uid)
+    total_videos = len(reels)
     msg = [
         f"📊 <b>Your Stats</b>",
         f"• Total vids: <b>{total_videos}</b>",
@@ -289,7 +482,10 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if reels:
         msg.append("🎥 <b>Your Reel Links:</b>")
         msg += [f"• https://www.instagram.com/reel/{sc}/" for sc in reels]
-    await update.message.reply_text("\n".join(msg), parse_mode=ParseMode.HTML)
+    body = "\n".join(msg)
+    if _stats_version(uid) == version:
+        _stats_cache[uid] = (time.monotonic() + STATS_CACHE_TTL, body)
+    await update.message.reply_text(body, parse_mode=ParseMode.HTML)
 
 @debug_handler
 async def userstats(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -298,17 +494,11 @@ async def userstats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) != 1:
         return await update.message.reply_text("Usage: /userstats <user_id>")
     tid = int(context.args[0])
-    try:
-        chat = await context.bot.get_chat(tid)
-        full_name = " ".join(filter(None, [chat.first_name, chat.last_name]))
-    except:
-        full_name = str(tid)
-    async with AsyncSessionLocal() as s:
-        row = (await s.execute(text("SELECT total_views FROM users WHERE user_id=:u"), {"u": tid})).fetchone()
-        views = row[0] if row else 0
-        reels = [r[0] for r in (await s.execute(text("SELECT shortcode FROM reels WHERE user_id=:u"), {"u": tid})).fetchall()]
-        acc = (await s.execute(text("SELECT insta_handle FROM allowed_accounts WHERE user_id=:u"), {"u": tid})).fetchone()
-        handle = acc[0] if acc else "—"
+    # The Telegram lookup and the DB query are independent; wait on both together.
+    full_name, (views, reels, handles) = await asyncio.gather(
+        chat_full_name(context.bot, tid), db_pool.fetchrow(SQL_USER_STATS, tid)
+    )
+    handle = handles[0] if handles else "—"
     msg = [
         f"📊 <b>Stats for {full_name} (@{handle})</b>",
         f"• Total views: <b>{views}</b>",
@@ -320,17 +510,18 @@ async def userstats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def allstats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return await update.message.reply_text("🚫 Unauthorized")
-    async with AsyncSessionLocal() as s:
-        uids = [r[0] for r in (await s.execute(text("SELECT DISTINCT user_id FROM reels"))).fetchall()]
-    for uid in uids:
-        try:
-            chat = await context.bot.get_chat(uid)
-            full_name = " ".join(filter(None, [chat.first_name, chat.last_name]))
-        except:
-            full_name = str(uid)
-        reels = [r[0] for r in (await s.execute(text("SELECT shortcode FROM reels WHERE user_id=:u"), {"u": uid})).fetchall()]
-        acc = (await s.execute(text("SELECT insta_handle FROM allowed_accounts WHERE user_id=:u"), {"u": uid})).fetchone()
-        handle = acc[0] if acc else "—"
+    rows = await db_pool.fetch(
+        "SELECT r.user_id, array_agg(r.shortcode ORDER BY r.id), "
+        "(SELECT insta_handle FROM allowed_accounts a WHERE a.user_id=r.user_id LIMIT 1) "
+        "FROM reels r GROUP BY r.user_id"
+    )
+    sem = asyncio.Semaphore(TG_CONCURRENCY)
+    async def bounded_name(uid):
+        async with sem:
+            return await chat_full_name(context.bot, uid)
+    names = await asyncio.gather(*(bounded_name(uid) for uid, _, _ in rows))
+    for (uid, reels, handle), full_name in zip(rows, names):
+        handle = handle or "—"
         msg = [
             f"👤 <b>{full_name} (@{handle})</b>",
             "🎥 <b>Reels:</b>",
@@ -344,13 +535,15 @@ async def broadcast_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         return await update.message.reply_text("Usage: /broadcast_all <message>")
     message = " ".join(context.args)
-    async with AsyncSessionLocal() as s:
-        uids = [r[0] for r in (await s.execute(text("SELECT DISTINCT user_id FROM allowed_accounts"))).fetchall()]
-    for uid in uids:
-        try:
-            await context.bot.send_message(uid, message)
-        except Exception as e:
-            logger.warning(f"Broadcast to {uid} failed: {e}")
+    uids = [r[0] for r in await db_pool.fetch("SELECT DISTINCT user_id FROM allowed_accounts")]
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    async def send_one(uid):
+        async with sem:
+            try:
+                await context.bot.send_message(uid, message)
+            except Exception as e:
+                logger.warning(f"Broadcast to {uid} failed: {e}")
+    await asyncio.gather(*(send_one(uid) for uid in uids))
     await update.message.reply_text("✅ Broadcast sent.", parse_mode=ParseMode.HTML)
 
 @debug_handler
@@ -370,28 +563,47 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def exportstats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return await update.message.reply_text("🚫 Unauthorized")
-    async with AsyncSessionLocal() as s:
-        users = (await s.execute(text(
-            "SELECT u.user_id,u.username,u.total_views,a.insta_handle "
-            "FROM users u LEFT JOIN allowed_accounts a ON u.user_id=a.user_id"
-        ))).fetchall()
-        reels = (await s.execute(text("SELECT user_id,shortcode FROM reels"))).fetchall()
-    lines = []
-    for uid, uname, views, insta in users:
+    users = await db_pool.fetch(
+        "SELECT u.user_id,u.username,u.total_views,a.insta_handle,"
+        "ARRAY(SELECT shortcode FROM reels r WHERE r.user_id=u.user_id ORDER BY r.id) "
+        "FROM users u LEFT JOIN allowed_accounts a ON u.user_id=a.user_id"
+    )
+    # Written straight into the upload buffer instead of collecting a list of lines.
+    buf = io.BytesIO(); buf.name = "stats.txt"
+    out = io.TextIOWrapper(buf, encoding="utf-8", newline="\n")
+    for uid, uname, views, insta, reels in users:
         acct = f"@{insta}" if insta else "—"
-        lines.append(f"User {uid} ({uname or '—'}), Views: {views}, Insta: {acct}")
-        for u, sc in reels:
-            if u == uid:
-                lines.append(f"  • https://www.instagram.com/reel/{sc}/")
-        lines.append("")
-    import io
-    buf = io.BytesIO("\n".join(lines).encode()); buf.name = "stats.txt"
+        out.write(f"User {uid} ({uname or '—'}), Views: {views}, Insta: {acct}\n")
+        for sc in reels:
+            out.write(f"  • https://www.instagram.com/reel/{sc}/\n")
+        out.write("\n")
+    out.flush(); out.detach()
+    buf.seek(0)
     await update.message.reply_document(document=buf, filename="stats.txt")
 
 async def run_bot():
+    global db_pool, http_session, tg_app, _log_q
+    _lanes[:] = [asyncio.Lock() for _ in range(WORKER_LANES)]
+    _log_q = asyncio.Queue()
+    http_session = aiohttp.ClientSession(
+        # Fail fast on a dead host; a hung /addreel otherwise holds its user's lane.
+        timeout=aiohttp.ClientTimeout(total=20, connect=5, sock_read=15),
+        connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=60),
+    )
+    db_pool = await asyncpg.create_pool(
+        PG_DSN, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX,
+        statement_cache_size=1024, max_cached_statement_lifetime=0,
+        # keep idle connections (and their prepared statements) warm between bursts
+        max_inactive_connection_lifetime=1800,
+        # short OLTP queries only; JIT compilation costs more than it saves here
+        server_settings={"jit": "off"},
+    )
     await init_db()
-    asyncio.create_task(start_health_check_server())
-    app = ApplicationBuilder().token(TOKEN).build()
+    spawn(start_health_check_server())
+    app = tg_app = (
+        ApplicationBuilder().token(TOKEN).concurrent_updates(True)
+        .rate_limiter(AIORateLimiter(max_retries=1)).build()
+    )
     handlers = [
         ("start", start_cmd), ("addaccount", addaccount), ("removeaccount", removeaccount),
         ("addreel", addreel), ("removelink", removereel), ("clearreels", clearreels),
@@ -403,8 +615,25 @@ async def run_bot():
     for cmd, h in handlers:
         app.add_handler(CommandHandler(cmd, h))
     await app.initialize(); await app.start()
-    await app.updater.start_polling(drop_pending_updates=True)
-    await asyncio.Event().wait()
+    if LOG_GROUP_ID:
+        spawn(flush_logs(app.bot))
+    if WEBHOOK_URL:
+        # Updates are pushed to /webhook on the FastAPI server started above.
+        await app.bot.set_webhook(
+            f"{WEBHOOK_URL}/webhook", secret_token=WEBHOOK_SECRET, drop_pending_updates=True
+        )
+    else:
+        await app.updater.start_polling(drop_pending_updates=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await http_session.close()
+        await db_pool.close()
 
 if __name__ == "__main__":
-    asyncio.run(run_bot()) 
+    try:
+        import uvloop
+    except ImportError:
+        uvloop = None  # stock asyncio loop (e.g. on Windows)
+    # uvloop.run() rather than uvloop.install(), which is deprecated on 3.12+
+    (uvloop.run if uvloop else asyncio.run)(run_bot()) 